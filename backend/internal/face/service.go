@@ -176,7 +176,7 @@ func (s *Service) GetJobStatus(jobID string) (*JobStatusResponse, error) {
 
 // downloadAndEncodeBatch downloads images in parallel using a worker pool and encodes them as base64
 func (s *Service) downloadAndEncodeBatch(items []*models.CloudItem, token *models.Token) ([]string, error) {
-	const numWorkers = 10
+	const numWorkers = 16
 
 	// Pre-allocate results slice to maintain order
 	results := make([]string, len(items))
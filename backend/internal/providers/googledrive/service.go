@@ -13,6 +13,9 @@ import (
 	"time"
 )
 
+// maxIdleConnsPerHost matches the number of parallel face recognition download workers
+const maxIdleConnsPerHost = 16
+
 type Service struct {
 	httpClient *http.Client
 	baseURL    string
@@ -20,8 +23,12 @@ type Service struct {
 }
 
 func NewGoogleDriveService() *Service {
+	// Reuse connections across parallel image downloads instead of re-handshaking per file
+	transport := http.DefaultTransport.(*http.Transport).Clone()
+	transport.MaxIdleConnsPerHost = maxIdleConnsPerHost
+
 	return &Service{
-		httpClient: &http.Client{Timeout: 30 * time.Second},
+		httpClient: &http.Client{Timeout: 30 * time.Second, Transport: transport},
 		baseURL:    "https://www.googleapis.com/drive/v3",
 		config: &models.OAuthConfig{
 			ClientID:     os.Getenv("GOOGLEDRIVE_CLIENT_ID"),
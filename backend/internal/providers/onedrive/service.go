@@ -13,6 +13,9 @@ import (
 	"time"
 )
 
+// maxIdleConnsPerHost matches the number of parallel face recognition download workers
+const maxIdleConnsPerHost = 16
+
 type Service struct {
 	httpClient *http.Client
 	baseURL    string
@@ -21,8 +24,12 @@ type Service struct {
 
 // NewOneDriveService creates a new OneDrive service
 func NewOneDriveService() *Service {
+	// Reuse connections across parallel image downloads instead of re-handshaking per file
+	transport := http.DefaultTransport.(*http.Transport).Clone()
+	transport.MaxIdleConnsPerHost = maxIdleConnsPerHost
+
 	return &Service{
-		httpClient: &http.Client{Timeout: 30 * time.Second},
+		httpClient: &http.Client{Timeout: 30 * time.Second, Transport: transport},
 		baseURL:    "https://graph.microsoft.com/v1.0",
 		config: &models.OAuthConfig{
 			ClientID:     os.Getenv("ONEDRIVE_CLIENT_ID"),
@@ -0,0 +1,156 @@
+"""Face detection and encoding, kept out of main so process pool workers import only this module"""
+import logging
+from typing import List, Optional, Tuple
+import numpy as np
+import face_recognition
+import dlib
+import binascii
+from io import BytesIO
+from PIL import Image
+from turbojpeg import TurboJPEG, TJPF_RGB
+
+logger = logging.getLogger(__name__)
+
+# Encodings are compared through the cosine similarity of their unit vectors, a single dot
+# product. dlib descriptors are not unit length, so the raw Euclidean distance is recovered
+# from the similarity and the norms: ||a - b||^2 = |a|^2 + |b|^2 - 2 * |a| * |b| * cos(a, b)
+def _distances(similarities: np.ndarray, norms: np.ndarray, base_norm: float) -> np.ndarray:
+    """Euclidean distances between raw encodings with the given cosine similarities and norms"""
+    return np.sqrt(np.maximum(0.0, norms ** 2 + base_norm ** 2 - 2 * norms * base_norm * similarities))
+
+# Maximum distance between face encodings that is considered a match
+MATCH_DISTANCE_THRESHOLD = 0.7
+
+# Distance below which a face is a near-certain match and the remaining faces are skipped
+EARLY_MATCH_DISTANCE_THRESHOLD = 0.3
+
+# Longest image edge used for face detection, larger images are downscaled first
+MAX_DETECTION_EDGE = 800
+
+# Target size for JPEG decoding, oversized JPEGs are downscaled by libjpeg while decoding
+DECODE_DRAFT_SIZE = (1024, 1024)
+
+JPEG_MAGIC = b'\xff\xd8\xff'
+
+# Fall back to PIL for every format if the native libjpeg-turbo library is missing
+try:
+    turbo_jpeg = TurboJPEG()
+except (OSError, RuntimeError) as e:
+    logger.warning(f"libjpeg-turbo unavailable, decoding JPEGs with PIL: {e}")
+    turbo_jpeg = None
+
+def quantize(encodings: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Quantize unit encodings to int8 along the last axis, returning the values and their scale factors"""
+    quantized = np.clip(np.rint(encodings * (127 / np.abs(encodings).max(axis=-1, keepdims=True))), -127, 127)
+    # Scaling by the inverse norm of the quantized vector itself turns int8 dot products into
+    # cosine similarities without the bias the per-component rounding would otherwise add
+    scale = 1 / np.linalg.norm(quantized, axis=-1, keepdims=True)
+    return quantized.astype(np.int8), scale
+
+def decode_base64(image_base64: str) -> bytes:
+    """Decode base64 image data without validation"""
+    # a2b_base64 reads ASCII strings in place, b64decode first copies them into a bytes object
+    return binascii.a2b_base64(image_base64)
+
+def _jpeg_scaling_factor(width: int, height: int) -> Tuple[int, int]:
+    """Pick the smallest libjpeg-turbo scaling factor that keeps the image at least DECODE_DRAFT_SIZE"""
+    target_width, target_height = DECODE_DRAFT_SIZE
+    candidates = [
+        (num, denom) for num, denom in turbo_jpeg.scaling_factors
+        if num <= denom and width * num // denom >= target_width and height * num // denom >= target_height
+    ]
+    return min(candidates, key=lambda factor: factor[0] / factor[1], default=(1, 1))
+
+def load_image(image_data: bytes) -> np.ndarray:
+    """Decode image bytes in memory into an RGB array"""
+    if turbo_jpeg is not None and image_data.startswith(JPEG_MAGIC):
+        # libjpeg-turbo decodes and scales straight into an RGB array in a single pass
+        try:
+            width, height, _, _ = turbo_jpeg.decode_header(image_data)
+            return turbo_jpeg.decode(
+                image_data, pixel_format=TJPF_RGB, scaling_factor=_jpeg_scaling_factor(width, height)
+            )
+        except Exception as e:
+            logger.debug(f"TurboJPEG decode failed, falling back to PIL: {e}")
+    
+    # Other formats and JPEGs TurboJPEG cannot handle (e.g. CMYK) go through PIL
+    image = Image.open(BytesIO(image_data))
+    # Let libjpeg scale oversized JPEGs in the DCT domain, a no-op for other formats
+    image.draft('RGB', DECODE_DRAFT_SIZE)
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    return np.array(image)
+
+def _detect_faces(image_array: np.ndarray) -> List[tuple]:
+    """Run HOG face detection with one upsampled pyramid level, finding faces down to about 40px"""
+    return face_recognition.face_locations(image_array, number_of_times_to_upsample=1, model='hog')
+
+def locate_faces(image_array: np.ndarray) -> List[tuple]:
+    """Detect faces on a downscaled copy of the image and map the boxes back to full resolution"""
+    height, width = image_array.shape[:2]
+    scale = min(1.0, MAX_DETECTION_EDGE / max(height, width))
+    if scale == 1.0:
+        return _detect_faces(image_array)
+    
+    small_image = Image.fromarray(image_array).resize(
+        (int(width * scale), int(height * scale)), Image.BILINEAR
+    )
+    face_locations = _detect_faces(np.array(small_image))
+    
+    return [
+        (
+            max(0, int(top / scale)),
+            min(width, int(right / scale)),
+            min(height, int(bottom / scale)),
+            max(0, int(left / scale)),
+        )
+        for top, right, bottom, left in face_locations
+    ]
+
+def encode_faces(image_array: np.ndarray, face_locations: List[tuple]) -> np.ndarray:
+    """Compute the encodings of all faces in an image in a single batched ResNet pass"""
+    # face_recognition.face_encodings runs the network once per face, dlib accepts
+    # all landmark sets of an image at once and batches them (on the GPU if built with CUDA)
+    landmarks = dlib.full_object_detections()
+    for top, right, bottom, left in face_locations:
+        landmarks.append(face_recognition.api.pose_predictor_5_point(
+            image_array, dlib.rectangle(left, top, right, bottom)
+        ))
+    descriptors = face_recognition.api.face_encoder.compute_face_descriptor(image_array, landmarks, 1)
+    return np.asarray(descriptors, dtype=np.float32).reshape(-1, 128)
+
+def _best_distance(
+    encodings_matrix: np.ndarray, base_encoding: np.ndarray, base_scale: np.ndarray, base_norm: float
+) -> float:
+    """Compare face encodings against the base face with a single int8 matmul"""
+    norms = np.linalg.norm(encodings_matrix, axis=1)
+    quantized, scales = quantize(encodings_matrix / norms[:, None])
+    similarities = (quantized.astype(np.int32) @ base_encoding.astype(np.int32)) * scales[:, 0] * base_scale
+    return float(_distances(similarities, norms, base_norm).min())
+
+def encode_and_match(
+    image_base64: str, base_encoding: np.ndarray, base_scale: np.ndarray, base_norm: float
+) -> Optional[float]:
+    """Process pool worker: return the distance of the best matching face in an image, if any"""
+    image_array = load_image(decode_base64(image_base64))
+    
+    face_locations = locate_faces(image_array)
+    
+    if len(face_locations) == 0:
+        return None
+    
+    # Largest faces first, the subject of a photo is most likely the biggest face
+    face_locations.sort(key=lambda location: (location[2] - location[0]) * (location[1] - location[3]), reverse=True)
+    
+    base = (base_encoding, base_scale, base_norm)
+    best_distance = _best_distance(encode_faces(image_array, face_locations[:1]), *base)
+    
+    # Only encode the remaining faces if the largest one is not already a near-certain match
+    if best_distance >= EARLY_MATCH_DISTANCE_THRESHOLD and len(face_locations) > 1:
+        remaining_encodings = encode_faces(image_array, face_locations[1:])
+        best_distance = min(best_distance, _best_distance(remaining_encodings, *base))
+    
+    if best_distance > MATCH_DISTANCE_THRESHOLD:
+        return None
+    
+    return best_distance
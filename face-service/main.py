@@ -1,61 +1,108 @@
-from fastapi import FastAPI, HTTPException, BackgroundTasks
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import ORJSONResponse
+from fastapi.routing import APIRoute
 from pydantic import BaseModel
 import logging
-from typing import Dict, Optional, List
+from typing import Dict, Optional, List, Tuple
 import numpy as np
-import face_recognition
-import base64
-from io import BytesIO
-from PIL import Image
 import uuid
-from datetime import datetime, timedelta
+import hashlib
+from collections import OrderedDict
+from datetime import datetime
+import time
 import asyncio
 import threading
+import os
+import multiprocessing
+import orjson
+import redis
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from face_processing import quantize, decode_base64, load_image, locate_faces, encode_faces, encode_and_match
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 class SessionData:
-    def __init__(self, encoding: np.ndarray):
+    __slots__ = ('encoding', 'scale', 'norm', 'slot')
+    
+    def __init__(self, encoding: np.ndarray, scale: np.ndarray, norm: float, slot: int):
         self.encoding = encoding
-        self.created_at = datetime.now()
-        self.last_accessed = datetime.now()
+        self.scale = scale
+        self.norm = norm
+        self.slot = slot
+
+# Access time of unused session slots, never older than the expiration cutoff
+UNUSED_SLOT_NS = np.iinfo(np.int64).max
 
 class SessionStore:
-    def __init__(self):
+    def __init__(self, capacity: int = 1024):
         self.sessions: Dict[str, SessionData] = {}
-        self.session_ttl = timedelta(hours=24)
+        self.session_ttl_ns = 24 * 3600 * 1_000_000_000
+        # Session IDs and last access times in parallel arrays indexed by slot,
+        # so expired sessions are found with a single vectorized comparison
+        self._ids = np.empty(capacity, dtype=object)
+        self._last_accessed_ns = np.full(capacity, UNUSED_SLOT_NS, dtype=np.int64)
+        self._free_slots: List[int] = list(range(capacity - 1, -1, -1))
+        self._lock = threading.Lock()
         self._start_cleanup_task()
     
+    def _allocate_slot(self, session_id: str) -> int:
+        if not self._free_slots:
+            # Double the capacity when all slots are in use
+            capacity = len(self._ids)
+            self._ids = np.concatenate([self._ids, np.empty(capacity, dtype=object)])
+            self._last_accessed_ns = np.concatenate(
+                [self._last_accessed_ns, np.full(capacity, UNUSED_SLOT_NS, dtype=np.int64)]
+            )
+            self._free_slots.extend(range(2 * capacity - 1, capacity - 1, -1))
+        slot = self._free_slots.pop()
+        self._ids[slot] = session_id
+        return slot
+    
+    def _release_slot(self, slot: int) -> None:
+        self._ids[slot] = None
+        self._last_accessed_ns[slot] = UNUSED_SLOT_NS
+        self._free_slots.append(slot)
+    
     def store(self, session_id: str, encoding: np.ndarray) -> None:
-        self.sessions[session_id] = SessionData(encoding)
+        """Store an encoding as its norm and its unit vector quantized to int8"""
+        norm = float(np.linalg.norm(encoding))
+        quantized, scale = quantize(encoding / norm)
+        with self._lock:
+            existing = self.sessions.get(session_id)
+            slot = existing.slot if existing else self._allocate_slot(session_id)
+            self.sessions[session_id] = SessionData(quantized, scale, norm, slot)
+            self._last_accessed_ns[slot] = time.monotonic_ns()
     
-    def retrieve(self, session_id: str) -> Optional[np.ndarray]:
-        session_data = self.sessions.get(session_id)
-        if session_data:
-            session_data.last_accessed = datetime.now()
-            return session_data.encoding
-        return None
+    def retrieve(self, session_id: str) -> Optional[Tuple[np.ndarray, np.ndarray, float]]:
+        """Return the quantized unit encoding, its scale factor and the original norm"""
+        with self._lock:
+            session_data = self.sessions.get(session_id)
+            if session_data:
+                self._last_accessed_ns[session_data.slot] = time.monotonic_ns()
+                return session_data.encoding, session_data.scale, session_data.norm
+            return None
     
     def delete(self, session_id: str) -> bool:
-        if session_id in self.sessions:
-            del self.sessions[session_id]
-            return True
-        return False
+        with self._lock:
+            session_data = self.sessions.pop(session_id, None)
+            if session_data:
+                self._release_slot(session_data.slot)
+                return True
+            return False
     
     def cleanup_expired_sessions(self) -> int:
         """Remove sessions that have exceeded the TTL"""
-        now = datetime.now()
-        expired_sessions = []
-        
-        for session_id, session_data in self.sessions.items():
-            if now - session_data.last_accessed > self.session_ttl:
-                expired_sessions.append(session_id)
+        cutoff_ns = time.monotonic_ns() - self.session_ttl_ns
         
-        for session_id in expired_sessions:
-            del self.sessions[session_id]
+        with self._lock:
+            expired_slots = np.flatnonzero(self._last_accessed_ns < cutoff_ns)
+            for slot in expired_slots.tolist():
+                del self.sessions[self._ids[slot]]
+                self._release_slot(slot)
         
-        return len(expired_sessions)
+        return len(expired_slots)
     
     def _start_cleanup_task(self):
         """Start the background cleanup task"""
@@ -71,20 +118,44 @@ class SessionStore:
         cleanup_thread = threading.Thread(target=cleanup_worker, daemon=True)
         cleanup_thread.start()
 
-class MatchResult:
-    def __init__(self, index: int, distance: float):
-        self.index = index
-        self.distance = distance
+class EncodingCache:
+    """LRU cache of base face encodings keyed by the image content hash"""
+    def __init__(self, max_size: int = 512):
+        self.encodings: OrderedDict[bytes, np.ndarray] = OrderedDict()
+        self.max_size = max_size
+        self._lock = threading.Lock()
+    
+    def get(self, key: bytes) -> Optional[np.ndarray]:
+        with self._lock:
+            encoding = self.encodings.get(key)
+            if encoding is not None:
+                self.encodings.move_to_end(key)
+            return encoding
+    
+    def put(self, key: bytes, encoding: np.ndarray) -> None:
+        with self._lock:
+            self.encodings[key] = encoding
+            self.encodings.move_to_end(key)
+            if len(self.encodings) > self.max_size:
+                self.encodings.popitem(last=False)
+
+# Matches of a job, written in place as images complete
+MATCH_DTYPE = np.dtype([('index', np.int32), ('distance', np.float64)])
 
 class JobStatus:
-    def __init__(self, job_id: str, total_images: int):
+    __slots__ = (
+        'job_id', 'status', 'progress', 'current_image', 'total_images',
+        'matches_found', 'matches', 'message', 'error', 'created_at',
+    )
+    
+    def __init__(self, job_id: str, total_images: int, matches: Optional[np.ndarray] = None):
         self.job_id = job_id
         self.status = "processing"
         self.progress = 0
         self.current_image = 0
         self.total_images = total_images
         self.matches_found = 0
-        self.matches: List[MatchResult] = []
+        self.matches = matches if matches is not None else np.zeros(total_images, dtype=MATCH_DTYPE)
         self.message = "Starting processing..."
         self.error: Optional[str] = None
         self.created_at = datetime.now()
@@ -94,29 +165,31 @@ class JobStore:
         self.jobs: Dict[str, JobStatus] = {}
     
     def create_job(self, total_images: int) -> str:
-        job_id = str(uuid.uuid4())
+        job_id = uuid.uuid4().hex
         self.jobs[job_id] = JobStatus(job_id, total_images)
         return job_id
     
     def get_job(self, job_id: str) -> Optional[JobStatus]:
         return self.jobs.get(job_id)
     
-    def update_progress(self, job_id: str, current: int, matches_found: int):
+    def update_progress(self, job_id: str, current: int, match: Optional[Tuple[int, float]] = None):
         job = self.jobs.get(job_id)
         if job:
+            if match is not None:
+                job.matches[job.matches_found] = match
+                job.matches_found += 1
             job.current_image = current
-            job.matches_found = matches_found
             job.progress = int((current / job.total_images) * 100) if job.total_images > 0 else 0
             job.message = f"Processing image {current} of {job.total_images}"
     
-    def complete_job(self, job_id: str, matches: List[MatchResult]):
+    def complete_job(self, job_id: str):
         job = self.jobs.get(job_id)
         if job:
+            # Images complete out of order, return matches sorted by image index
+            job.matches[:job.matches_found].sort(order='index')
             job.status = "completed"
             job.progress = 100
-            job.matches = matches
-            job.matches_found = len(matches)
-            job.message = f"Completed! Found {len(matches)} matches"
+            job.message = f"Completed! Found {job.matches_found} matches"
     
     def fail_job(self, job_id: str, error: str):
         job = self.jobs.get(job_id)
@@ -131,14 +204,190 @@ class JobStore:
             return True
         return False
 
+class RedisJobStore:
+    """Job store backed by Redis, so job state survives worker restarts and interrupted jobs fail fast"""
+    def __init__(self, redis_url: str, job_ttl: int = 3600, heartbeat_interval: int = 10):
+        self.redis = redis.Redis.from_url(redis_url, decode_responses=True)
+        self.job_ttl = job_ttl  # seconds, refreshed on every update
+        # Jobs are processed by the worker that created them, a job whose owner stopped
+        # sending heartbeats was interrupted and is reported as failed
+        self.worker_id = uuid.uuid4().hex
+        self.heartbeat_interval = heartbeat_interval  # seconds
+        self._heartbeat_started = False
+        self._heartbeat_lock = threading.Lock()
+    
+    @staticmethod
+    def _key(job_id: str) -> str:
+        return f"job:{job_id}"
+    
+    @staticmethod
+    def _matches_key(job_id: str) -> str:
+        return f"job:{job_id}:matches"
+    
+    @staticmethod
+    def _worker_key(worker_id: str) -> str:
+        return f"worker:{worker_id}"
+    
+    def _send_heartbeat(self, pipeline=None) -> None:
+        (pipeline if pipeline is not None else self.redis).set(self._worker_key(self.worker_id), 1, ex=3 * self.heartbeat_interval)
+    
+    def _start_heartbeat_task(self):
+        """Start the background heartbeat task once this worker owns a job"""
+        with self._heartbeat_lock:
+            if self._heartbeat_started:
+                return
+            self._heartbeat_started = True
+        
+        def heartbeat_worker():
+            while True:
+                threading.Event().wait(self.heartbeat_interval)
+                try:
+                    self._send_heartbeat()
+                except Exception as e:
+                    logger.error(f"Error sending job store heartbeat: {e}")
+        
+        heartbeat_thread = threading.Thread(target=heartbeat_worker, daemon=True)
+        heartbeat_thread.start()
+    
+    @staticmethod
+    def _failed_fields(error: str) -> Dict[str, object]:
+        return {
+            "status": "failed",
+            "error": error,
+            "message": f"Failed: {error}",
+        }
+    
+    def _update(self, job_id: str, fields: Dict[str, object], match: Optional[Tuple[int, float]] = None) -> None:
+        pipeline = self.redis.pipeline()
+        pipeline.hset(self._key(job_id), mapping=fields)
+        if match is not None:
+            pipeline.rpush(self._matches_key(job_id), orjson.dumps(match))
+            pipeline.hincrby(self._key(job_id), "matches_found", 1)
+        pipeline.expire(self._key(job_id), self.job_ttl)
+        pipeline.expire(self._matches_key(job_id), self.job_ttl)
+        pipeline.execute()
+    
+    def create_job(self, total_images: int) -> str:
+        self._start_heartbeat_task()
+        job_id = uuid.uuid4().hex
+        job = JobStatus(job_id, total_images, matches=np.empty(0, dtype=MATCH_DTYPE))
+        pipeline = self.redis.pipeline()
+        self._send_heartbeat(pipeline)
+        pipeline.hset(self._key(job_id), mapping={
+            "status": job.status,
+            "progress": job.progress,
+            "current_image": job.current_image,
+            "total_images": job.total_images,
+            "matches_found": job.matches_found,
+            "message": job.message,
+            "owner": self.worker_id,
+        })
+        pipeline.expire(self._key(job_id), self.job_ttl)
+        pipeline.execute()
+        return job_id
+    
+    def get_job(self, job_id: str) -> Optional[JobStatus]:
+        pipeline = self.redis.pipeline()
+        pipeline.hgetall(self._key(job_id))
+        pipeline.lrange(self._matches_key(job_id), 0, -1)
+        fields, matches = pipeline.execute()
+        if not fields:
+            return None
+        
+        if fields["status"] == "processing" and not self.redis.exists(self._worker_key(fields["owner"])):
+            failed_fields = self._failed_fields("Job was interrupted, the worker processing it stopped")
+            self._update(job_id, failed_fields)
+            fields.update(failed_fields)
+        
+        matches = np.array([tuple(orjson.loads(match)) for match in matches], dtype=MATCH_DTYPE)
+        matches.sort(order='index')
+        job = JobStatus(job_id, int(fields["total_images"]), matches)
+        job.status = fields["status"]
+        job.progress = int(fields["progress"])
+        job.current_image = int(fields["current_image"])
+        job.matches_found = int(fields["matches_found"])
+        job.message = fields["message"]
+        job.error = fields.get("error")
+        return job
+    
+    def update_progress(self, job_id: str, current: int, match: Optional[Tuple[int, float]] = None):
+        total_images = self.redis.hget(self._key(job_id), "total_images")
+        if total_images is not None:
+            total_images = int(total_images)
+            self._update(job_id, {
+                "current_image": current,
+                "progress": int((current / total_images) * 100) if total_images > 0 else 0,
+                "message": f"Processing image {current} of {total_images}",
+            }, match)
+    
+    def complete_job(self, job_id: str):
+        matches_found = self.redis.hget(self._key(job_id), "matches_found")
+        if matches_found is not None:
+            self._update(job_id, {
+                "status": "completed",
+                "progress": 100,
+                "message": f"Completed! Found {matches_found} matches",
+            })
+    
+    def fail_job(self, job_id: str, error: str):
+        if self.redis.exists(self._key(job_id)):
+            self._update(job_id, self._failed_fields(error))
+    
+    def delete_job(self, job_id: str) -> bool:
+        return self.redis.delete(self._key(job_id), self._matches_key(job_id)) > 0
+
+# Keep job state in Redis when configured, otherwise in process memory
+REDIS_URL = os.getenv("REDIS_URL")
+
 session_store = SessionStore()
-job_store = JobStore()
+job_store = RedisJobStore(REDIS_URL) if REDIS_URL else JobStore()
+encoding_cache = EncodingCache()
+def _create_process_pool() -> ProcessPoolExecutor:
+    # Start workers from a forkserver, forking this multithreaded process can deadlock them
+    return ProcessPoolExecutor(max_workers=os.cpu_count(), mp_context=multiprocessing.get_context("forkserver"))
+
+process_pool = _create_process_pool()
+process_pool_lock = threading.Lock()
+
+def _replace_process_pool(broken_pool: ProcessPoolExecutor) -> None:
+    """Replace a pool that lost a worker, a broken pool rejects all further work"""
+    global process_pool
+    with process_pool_lock:
+        if process_pool is broken_pool:
+            process_pool = _create_process_pool()
+    broken_pool.shutdown(wait=False, cancel_futures=True)
+
+# Runs request-path face encoding off the event loop on a single thread, face_recognition's
+# detector, shape predictor and ResNet are shared dlib objects that must not run concurrently
+thread_pool = ThreadPoolExecutor(max_workers=1)
+
+# Runs batch jobs, each of which waits on the process pool until all of its images are done.
+# Starlette background tasks would hold its threadpool, which the request handlers need.
+batch_job_pool = ThreadPoolExecutor(max_workers=os.cpu_count())
+
+class ORJSONRequest(Request):
+    """Request that parses JSON bodies with orjson, batch requests carry large base64 payloads"""
+    async def json(self):
+        if not hasattr(self, "_json"):
+            self._json = orjson.loads(await self.body())
+        return self._json
+
+class ORJSONRoute(APIRoute):
+    def get_route_handler(self):
+        route_handler = super().get_route_handler()
+        
+        async def orjson_route_handler(request: Request):
+            return await route_handler(ORJSONRequest(request.scope, request.receive))
+        
+        return orjson_route_handler
 
 app = FastAPI(
     title="Face Recognition Service",
     description="Microservice for face detection and comparison",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse
 )
+app.router.route_class = ORJSONRoute
 
 @app.get("/health")
 async def health_check():
@@ -184,42 +433,50 @@ class JobStatusResponse(BaseModel):
     matches: Optional[List[MatchResultModel]] = None
     error: Optional[str] = None
 
+def _encode_base_face(image_data: bytes) -> np.ndarray:
+    """Extract the encoding of the single face in a base image"""
+    # Decode the image
+    try:
+        image_array = load_image(image_data)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail="Invalid image format")
+    
+    # Detect faces in the image
+    face_locations = locate_faces(image_array)
+    
+    # Validate exactly one face is detected
+    if len(face_locations) == 0:
+        raise HTTPException(status_code=400, detail="No face detected in image")
+    
+    if len(face_locations) > 1:
+        raise HTTPException(status_code=400, detail="Multiple faces detected, please use image with single face")
+    
+    # Extract face encoding
+    face_encodings = encode_faces(image_array, face_locations)
+    
+    if len(face_encodings) == 0:
+        raise HTTPException(status_code=500, detail="Failed to extract face encoding")
+    
+    return face_encodings[0]
+
 @app.post("/face/register", response_model=RegisterResponse)
 async def register_face(request: RegisterRequest):
     """Register a base face for a session"""
     try:
         # Decode base64 image
         try:
-            image_data = base64.b64decode(request.image)
+            image_data = decode_base64(request.image)
         except Exception as e:
             raise HTTPException(status_code=400, detail="Invalid image format")
         
-        # Load image with PIL
-        try:
-            image = Image.open(BytesIO(image_data))
-            if image.mode != 'RGB':
-                image = image.convert('RGB')
-            image_array = np.array(image)
-        except Exception as e:
-            raise HTTPException(status_code=400, detail="Invalid image format")
-        
-        # Detect faces in the image
-        face_locations = face_recognition.face_locations(image_array)
-        
-        # Validate exactly one face is detected
-        if len(face_locations) == 0:
-            raise HTTPException(status_code=400, detail="No face detected in image")
-        
-        if len(face_locations) > 1:
-            raise HTTPException(status_code=400, detail="Multiple faces detected, please use image with single face")
-        
-        # Extract face encoding
-        face_encodings = face_recognition.face_encodings(image_array, face_locations)
-        
-        if len(face_encodings) == 0:
-            raise HTTPException(status_code=500, detail="Failed to extract face encoding")
-        
-        face_encoding = face_encodings[0]
+        # Reuse the encoding when the same image is registered again, e.g. on client retries
+        image_key = hashlib.blake2b(image_data, digest_size=16).digest()
+        face_encoding = encoding_cache.get(image_key)
+        if face_encoding is None:
+            face_encoding = await asyncio.get_running_loop().run_in_executor(
+                thread_pool, _encode_base_face, image_data
+            )
+            encoding_cache.put(image_key, face_encoding)
         
         session_store.store(request.session_id, face_encoding)
         return RegisterResponse(success=True)
@@ -232,67 +489,58 @@ async def register_face(request: RegisterRequest):
 
 def process_batch_background(job_id: str, session_id: str, images: List[str]):
     """Background task to process images"""
+    futures: Dict[Future, int] = {}
     try:
-        base_encoding = session_store.retrieve(session_id)
-        if base_encoding is None:
+        base = session_store.retrieve(session_id)
+        if base is None:
             job_store.fail_job(job_id, "Session not found")
             return
         
-        matches = []
-        total_images = len(images)
-        
+        # Fan the images out across all CPU cores, face detection dominates the cost
+        pool = process_pool
         for idx, image_base64 in enumerate(images):
+            futures[pool.submit(encode_and_match, image_base64, *base)] = idx
+        
+        for processed, future in enumerate(as_completed(futures), start=1):
+            idx = futures[future]
+            match = None
             try:
-                image_data = base64.b64decode(image_base64)
-                image = Image.open(BytesIO(image_data))
-                if image.mode != 'RGB':
-                    image = image.convert('RGB')
-                image_array = np.array(image)
-                
-                face_locations = face_recognition.face_locations(image_array)
-                
-                if len(face_locations) > 0:
-                    face_encodings = face_recognition.face_encodings(image_array, face_locations)
-                    
-                    # Compare all faces in the image and keep the best match
-                    best_distance = float('inf')
-                    
-                    for face_encoding in face_encodings:
-                        # Calculate face distance
-                        distances = face_recognition.face_distance([base_encoding], face_encoding)
-                        distance = distances[0]
-                        
-                        # Use 0.7 as the maximum threshold and track the best matching distance
-                        if distance <= 0.7 and distance < best_distance:
-                            best_distance = distance
-                    
-                    # If any face matched, add the image with the best distance
-                    if best_distance <= 0.7:
-                        matches.append(MatchResult(idx, float(best_distance)))
-                
-                job_store.update_progress(job_id, idx + 1, len(matches))
-                        
+                # If any face matched, record the image with the distance of the best match
+                best_distance = future.result()
+                if best_distance is not None:
+                    match = (idx, best_distance)
+            except BrokenProcessPool:
+                raise
             except Exception as e:
                 logger.warning(f"Failed to process image at index {idx} for job {job_id}: {e}")
-                continue
+            
+            job_store.update_progress(job_id, processed, match)
         
-        job_store.complete_job(job_id, matches)
+        job_store.complete_job(job_id)
         
+    except BrokenProcessPool as e:
+        logger.error(f"Process pool broke during job {job_id}: {e}")
+        job_store.fail_job(job_id, "Image processing worker crashed")
+        _replace_process_pool(pool)
     except Exception as e:
         logger.error(f"Unexpected error in background processing for job {job_id}: {e}")
         job_store.fail_job(job_id, str(e))
+    finally:
+        # Images of a failed job must not hold up other jobs on the shared pool
+        for future in futures:
+            future.cancel()
 
+# Plain def handlers run in the threadpool, the job store may block on Redis
 @app.post("/face/compare-batch", response_model=CompareBatchResponse)
-async def compare_batch(request: CompareBatchRequest, background_tasks: BackgroundTasks):
+def compare_batch(request: CompareBatchRequest):
     """Start a batch comparison job"""
     try:
-        base_encoding = session_store.retrieve(request.session_id)
-        if base_encoding is None:
+        if session_store.retrieve(request.session_id) is None:
             raise HTTPException(status_code=404, detail="Session not found")
         
         job_id = job_store.create_job(len(request.images))
         
-        background_tasks.add_task(process_batch_background, job_id, request.session_id, request.images)
+        batch_job_pool.submit(process_batch_background, job_id, request.session_id, request.images)
         
         return CompareBatchResponse(
             job_id=job_id,
@@ -306,7 +554,7 @@ async def compare_batch(request: CompareBatchRequest, background_tasks: Backgrou
         raise HTTPException(status_code=500, detail="Internal server error")
 
 @app.get("/face/job-status/{job_id}", response_model=JobStatusResponse)
-async def get_job_status(job_id: str):
+def get_job_status(job_id: str):
     """Get the status of a comparison job"""
     try:
         job = job_store.get_job(job_id)
@@ -314,10 +562,13 @@ async def get_job_status(job_id: str):
         if job is None:
             raise HTTPException(status_code=404, detail="Job not found")
         
-        # Convert MatchResult objects to MatchResultModel for the response
+        # Convert the recorded matches to MatchResultModel for the response
         matches_data = None
-        if job.status == "completed" and job.matches:
-            matches_data = [MatchResultModel(index=m.index, distance=m.distance) for m in job.matches]
+        if job.status == "completed" and job.matches_found > 0:
+            matches_data = [
+                MatchResultModel(index=index, distance=distance)
+                for index, distance in job.matches[:job.matches_found].tolist()
+            ]
         
         return JobStatusResponse(
             job_id=job.job_id,